@@ -2,14 +2,17 @@ import torch
 import argparse
 import dgl
 import torch.multiprocessing as mp
+import torch.distributed as dist
 import os
+import shutil
+import tempfile
 import random
 import time
 import numpy as np
 
 from reading_data import DeepwalkDataset
 from model import SkipGramModel
-from utils import thread_wrapped_func, shuffle_walks
+from utils import shuffle_walks, init_lr_schedule, AliasSampler
 
 class DeepwalkTrainer:
     def __init__(self, args):
@@ -26,6 +29,7 @@ class DeepwalkTrainer:
             )
         self.emb_size = len(self.dataset.net)
         self.emb_model = None
+        self.optimizer = None
 
     def init_device_emb(self):
         """ set the device before training 
@@ -34,8 +38,11 @@ class DeepwalkTrainer:
         choices = sum([self.args.only_gpu, self.args.only_cpu, self.args.mix])
         assert choices == 1, "Must choose only *one* training mode in [only_cpu, only_gpu, mix]"
         assert self.args.num_procs >= 1, "The number of process must be larger than 1"
-        choices = sum([self.args.sgd, self.args.adam, self.args.avg_sgd])
-        assert choices == 1, "Must choose only *one* gradient descent strategy in [sgd, avg_sgd, adam]"
+        choices = sum([self.args.sgd, self.args.adam, self.args.avg_sgd, self.args.sparse_adam])
+        assert choices == 1, "Must choose only *one* gradient descent strategy in [sgd, avg_sgd, adam, sparse_adam]"
+        assert not (self.args.sparse_adam and self.args.mix), "sparse_adam only supports only_cpu or only_gpu"
+        assert not self.args.bf16 or (self.args.only_gpu and not self.args.sparse_adam), \
+            "bf16 only supports only_gpu without sparse_adam"
         
         # initializing embedding on CPU
         self.emb_model = SkipGramModel(
@@ -61,6 +68,8 @@ class DeepwalkTrainer:
         if self.args.only_gpu:
             print("Run in 1 GPU")
             self.emb_model.all_to_device(0)
+            if self.args.bf16:
+                self.emb_model.embeddings_to_bf16()
         elif self.args.mix:
             print("Mix CPU with %d GPU" % self.args.num_procs)
             if self.args.num_procs == 1:
@@ -68,6 +77,25 @@ class DeepwalkTrainer:
         else:
             print("Run in %d CPU process" % self.args.num_procs)
 
+        if self.args.sparse_adam:
+            # created after the embeddings are placed on their device
+            self.optimizer = torch.optim.SparseAdam(
+                list(self.emb_model.parameters()), lr=self.args.lr)
+
+    def init_neg_sampler(self, max_n, rank=0):
+        """ sampler of true negative nodes on the device holding the embeddings,
+        so that negative nodes are sampled where they are looked up
+        """
+        device = self.emb_model.u_embeddings.weight.device
+        generator = torch.Generator(device=device)
+        generator.manual_seed(self.args.seed + rank)
+        return AliasSampler(self.dataset.neg_prob.to(device),
+            self.dataset.neg_alias.to(device), max_n, generator)
+
+    def threads_per_proc(self):
+        """ number of CPU threads of a training subprocess """
+        return max(1, self.args.num_threads // self.args.num_procs)
+
     def train(self):
         """ train the embedding """
         if self.args.num_procs > 1:
@@ -80,71 +108,117 @@ class DeepwalkTrainer:
         self.init_device_emb()
         self.emb_model.share_memory()
         self.dataset.walks = shuffle_walks(self.dataset.walks)
+        # the spawned subprocesses map the walks and the negative alias table
+        # instead of receiving copies of them
+        self.dataset.walks.share_memory_()
+        if not self.args.fast_neg:
+            self.dataset.neg_prob.share_memory_()
+            self.dataset.neg_alias.share_memory_()
 
         start_all = time.time()
-        ps = []
-
-        l = len(self.dataset.walks)
-        np_ = self.args.num_procs
-        for i in range(np_):
-            walks = self.dataset.walks[int(i * l / np_): int((i + 1) * l / np_)]
-            p = mp.Process(target=self.fast_train_sp, args=(walks, i))
-            ps.append(p)
-            p.start()
-
-        for p in ps:
-            p.join()
+
+        # rendezvous file of the process group formed by the subprocesses
+        init_dir = tempfile.mkdtemp()
+        init_method = "file://" + os.path.join(init_dir, "dist_init")
+
+        # split the CPU threads among the subprocesses instead of giving
+        # num_threads to each of them. The environment is inherited by the
+        # spawned subprocesses, so it is read before OpenMP starts in them.
+        os.environ["OMP_NUM_THREADS"] = str(self.threads_per_proc())
+
+        # spawn rather than fork, so that subprocesses never inherit
+        # the CUDA context of the parent. The trainer is pickled for every
+        # subprocess, without the network dict, the id maps and the graph
+        # (see DeepwalkDataset.__getstate__), which only the parent uses, and
+        # every subprocess gets its own gradient buffers (see
+        # SkipGramModel.__getstate__).
+        try:
+            mp.spawn(self.fast_train_sp, args=(init_method,),
+                nprocs=self.args.num_procs, join=True)
+        finally:
+            shutil.rmtree(init_dir, ignore_errors=True)
         
         print("Used time: %.2fs" % (time.time()-start_all))
         self.emb_model.save_embedding(self.dataset, self.args.emb_file)
 
-    @thread_wrapped_func
-    def fast_train_sp(self, walks, gpu_id):
-        """ a subprocess for fast_train_mp """
-        # number of batches in this process
-        num_batches = int(np.ceil(len(walks) / self.args.batch_size))
-        # number of positive node pairs in a sequence
-        num_pos = int(2 * self.args.walk_length * self.args.window_size\
-            - self.args.window_size * (self.args.window_size + 1))
-        print("num batchs: %d in subprocess [%d]" % (num_batches, gpu_id))
-        self.emb_model.set_device(gpu_id)
-        torch.set_num_threads(self.args.num_threads)
+    def fast_train_sp(self, gpu_id, init_method):
+        """ a subprocess for fast_train_mp, training on the gpu_id-th slice of walks
 
-        start = time.time()
-        with torch.no_grad():
-            i = 0
+        The embeddings are shared across subprocesses and updated in place
+        (hogwild), so there are no gradients to all-reduce. The subprocesses
+        only join a gloo process group to coordinate with each other.
+        """
+        dist.init_process_group(backend="gloo", init_method=init_method,
+            rank=gpu_id, world_size=self.args.num_procs)
+        try:
+            l = len(self.dataset.walks)
+            np_ = self.args.num_procs
+            walks = self.dataset.walks[int(gpu_id * l / np_): int((gpu_id + 1) * l / np_)]
+            # number of batches in this process
+            num_batches = int(np.ceil(len(walks) / self.args.batch_size))
+            # number of positive node pairs in a sequence
+            num_pos = int(2 * self.args.walk_length * self.args.window_size\
+                - self.args.window_size * (self.args.window_size + 1))
+            print("num batchs: %d in subprocess [%d]" % (num_batches, gpu_id))
+            if not self.args.only_cpu:
+                self.emb_model.set_device(gpu_id)
+            torch.set_num_threads(self.threads_per_proc())
+
+            # loop invariants, kept out of the per-batch path
+            batch_size = self.args.batch_size
+            num_neg = num_pos * self.args.negative
+            fast_neg = self.args.fast_neg
+            sparse_adam = self.args.sparse_adam
+            print_interval = self.args.print_interval
+            if not fast_neg:
+                neg_sampler = self.init_neg_sampler(batch_size * num_neg, gpu_id)
+
+            # the subprocesses hold slightly different numbers of batches, so they
+            # only synchronize within the batches all of them reach. This also
+            # makes them start updating the shared embeddings after every
+            # subprocess finished its device setup.
+            sync_every = self.args.sync_every
             max_i = self.args.iterations * num_batches
+            sync_end = torch.tensor([max_i])
+            dist.all_reduce(sync_end, op=dist.ReduceOp.MIN)
+            sync_end = int(sync_end)
+            start = time.time()
+            with torch.no_grad():
+                i = 0
+                lr_schedule = init_lr_schedule(self.args.lr, max_i)
             
-            while True:
-                # decay learning rate for SGD
-                lr = self.args.lr * (max_i - i) / max_i
-                if lr < 0.00001:
-                    lr = 0.00001
+                while i < max_i:
+                    # multi-sequence input
+                    i_ = i % num_batches
+                    if i_ == 0 and i > 0:
+                        # the walks were shuffled by the parent for the first iteration
+                        walks = shuffle_walks(walks)
+                    walks_ = walks[i_ * batch_size: (1+i_) * batch_size]
 
-                # multi-sequence input
-                i_ = int(i % num_batches)
-                walks_ = list(walks[i_ * self.args.batch_size: \
-                        (1+i_) * self.args.batch_size])
-                if len(walks_) == 0:
-                    break
-
-                if self.args.fast_neg:
-                    self.emb_model.fast_learn_super(walks_, lr)
-                else:
-                    # do negative sampling
-                    bs = len(walks_)
-                    neg_nodes = torch.LongTensor(
-                        np.random.choice(self.dataset.neg_table, 
-                            bs * num_pos * self.args.negative, 
-                            replace=True))
-                    self.emb_model.fast_learn_super(walks_, lr, neg_nodes=neg_nodes)
+                    # decay learning rate for SGD
+                    lr = lr_schedule[i]
 
-                i += 1
-                if i > 0 and i % self.args.print_interval == 0:
-                    print("Solver [%d] batch %d tt: %.2fs" % (gpu_id, i, time.time()-start))
-                    start = time.time()
-                if i_ == num_batches - 1:
-                    break
+                    if fast_neg:
+                        neg_nodes = None
+                    else:
+                        # do negative sampling
+                        neg_nodes = neg_sampler.sample(len(walks_) * num_neg)
+
+                    if sparse_adam:
+                        self.emb_model.sparse_adam_learn(walks_, self.optimizer, neg_nodes=neg_nodes)
+                    else:
+                        self.emb_model.fast_learn_super(walks_, lr, neg_nodes=neg_nodes)
+
+                    i += 1
+                    if i % print_interval == 0:
+                        print("Solver [%d] batch %d tt: %.2fs" % (gpu_id, i, time.time()-start))
+                        start = time.time()
+                    # bound the staleness between subprocesses with a barrier
+                    # every sync_every batches, never per batch
+                    if sync_every > 0 and i % sync_every == 0 and i <= sync_end:
+                        dist.barrier()
+        finally:
+            dist.destroy_process_group()
 
     def fast_train(self):
         """ one process """
@@ -158,45 +232,53 @@ class DeepwalkTrainer:
 
         self.init_device_emb()
 
+        # loop invariants, kept out of the per-batch path
+        batch_size = self.args.batch_size
+        num_neg = num_pos * self.args.negative
+        fast_neg = self.args.fast_neg
+        sparse_adam = self.args.sparse_adam
+        print_interval = self.args.print_interval
+        if not fast_neg:
+            neg_sampler = self.init_neg_sampler(batch_size * num_neg)
+
+        walks = self.dataset.walks
+        if self.args.only_gpu:
+            # the walks stay on GPU for all of the iterations
+            walks = walks.to(self.emb_model.device)
+
         start_all = time.time()
         start = time.time()
         with torch.no_grad():
             i = 0
             max_i = self.args.iterations * num_batches
-            for iteration in range(self.args.iterations):
-                print("\nIteration: " + str(iteration + 1))
-                self.dataset.walks = shuffle_walks(self.dataset.walks)
+            lr_schedule = init_lr_schedule(self.args.lr, max_i)
 
-                while True:
-                    # decay learning rate for SGD
-                    lr = self.args.lr * (max_i - i) / max_i
-                    if lr < 0.00001:
-                        lr = 0.00001
+            while i < max_i:
+                # multi-sequence input
+                i_ = i % num_batches
+                if i_ == 0:
+                    print("\nIteration: " + str(i // num_batches + 1))
+                    walks = shuffle_walks(walks)
+                batch_walks = walks[i_ * batch_size: (1+i_) * batch_size]
 
-                    # multi-sequence input
-                    i_ = int(i % num_batches)
-                    walks = list(self.dataset.walks[i_ * self.args.batch_size: \
-                            (1+i_) * self.args.batch_size])
-                    if len(walks) == 0:
-                        break
-
-                    if self.args.fast_neg:
-                        self.emb_model.fast_learn_super(walks, lr)
-                    else:
-                        # do negative sampling
-                        bs = len(walks)
-                        neg_nodes = torch.LongTensor(
-                            np.random.choice(self.dataset.neg_table, 
-                                bs * num_pos * self.args.negative, 
-                                replace=True))
-                        self.emb_model.fast_learn_super(walks, lr, neg_nodes=neg_nodes)
+                # decay learning rate for SGD
+                lr = lr_schedule[i]
 
-                    i += 1
-                    if i > 0 and i % self.args.print_interval == 0:
-                        print("Batch %d, training time: %.2fs" % (i, time.time()-start))
-                        start = time.time()
-                    if i_ == num_batches - 1:
-                        break
+                if fast_neg:
+                    neg_nodes = None
+                else:
+                    # do negative sampling
+                    neg_nodes = neg_sampler.sample(len(batch_walks) * num_neg)
+
+                if sparse_adam:
+                    self.emb_model.sparse_adam_learn(batch_walks, self.optimizer, neg_nodes=neg_nodes)
+                else:
+                    self.emb_model.fast_learn_super(batch_walks, lr, neg_nodes=neg_nodes)
+
+                i += 1
+                if i % print_interval == 0:
+                    print("Batch %d, training time: %.2fs" % (i, time.time()-start))
+                    start = time.time()
 
         print("Training used time: %.2fs" % (time.time()-start_all))
         self.emb_model.save_embedding(self.dataset, self.args.emb_file)
@@ -237,16 +319,26 @@ if __name__ == '__main__':
             help="training with GPU")
     parser.add_argument('--fast_neg', default=True, action="store_true", 
             help="do negative sampling inside a batch")
+    parser.add_argument('--no_fast_neg', dest="fast_neg", action="store_false", 
+            help="sample true negatives according to node degrees instead")
     parser.add_argument('--adam', default=False, action="store_true", 
             help="use adam for embedding updation")
     parser.add_argument('--sgd', default=False, action="store_true", 
             help="use sgd for embedding updation")
     parser.add_argument('--avg_sgd', default=False, action="store_true", 
             help="average gradients of sgd for embedding updation")
+    parser.add_argument('--sparse_adam', default=False, action="store_true", 
+            help="use torch.optim.SparseAdam with autograd for embedding updation")
+    parser.add_argument('--seed', default=3141592653, type=int, 
+            help="random seed of true negative sampling, offset by the process rank")
+    parser.add_argument('--bf16', default=False, action="store_true", 
+            help="store the embeddings in bfloat16 when training with GPU")
     parser.add_argument('--num_threads', default=8, type=int, 
-            help="number of threads used on CPU")
+            help="number of threads used on CPU, split among the processes")
     parser.add_argument('--num_procs', default=1, type=int, 
             help="number of GPUs/CPUs when mixed training")
+    parser.add_argument('--sync_every', default=4000, type=int, 
+            help="number of batches between synchronizing subprocesses, 0 to disable")
     args = parser.parse_args()
 
     start_time = time.time()
@@ -18,22 +18,24 @@ def init_emb2pos_index(walk_length, window_size, batch_size):
     # emb_u.shape: [batch_size * walk_length, dim]
     batch_emb2posu = torch.index_select(emb_u, 0, index_emb_posu)
     '''
+    # pairs of a single walk, the same for every walk in the batch
     idx_list_u = []
     idx_list_v = []
-    for b in range(batch_size):
-        for i in range(walk_length):
-            for j in range(i-window_size, i):
-                if j >= 0:
-                    idx_list_u.append(j + b * walk_length)
-                    idx_list_v.append(i + b * walk_length)
-            for j in range(i + 1, i + 1 + window_size):
-                if j < walk_length:
-                    idx_list_u.append(j + b * walk_length)
-                    idx_list_v.append(i + b * walk_length)
-
+    for i in range(walk_length):
+        for j in range(i-window_size, i):
+            if j >= 0:
+                idx_list_u.append(j)
+                idx_list_v.append(i)
+        for j in range(i + 1, i + 1 + window_size):
+            if j < walk_length:
+                idx_list_u.append(j)
+                idx_list_v.append(i)
+
+    # offset the pairs to every walk, walk by walk
     # [num_pos * batch_size]
-    index_emb_posu = torch.LongTensor(idx_list_u)
-    index_emb_posv = torch.LongTensor(idx_list_v)
+    offset = torch.arange(batch_size).unsqueeze(1) * walk_length
+    index_emb_posu = (torch.LongTensor(idx_list_u) + offset).view(-1)
+    index_emb_posv = (torch.LongTensor(idx_list_v) + offset).view(-1)
 
     return index_emb_posu, index_emb_posv
 
@@ -51,23 +53,24 @@ def init_emb2neg_index(walk_length, window_size, negative, batch_size):
     # emb_u.shape: [batch_size * walk_length, dim]
     batch_emb2negu = torch.index_select(emb_u, 0, index_emb_negu)
     '''
+    # center nodes of a single walk, the same for every walk in the batch
     idx_list_u = []
-    for b in range(batch_size):
-        for i in range(walk_length):
-            for j in range(i-window_size, i):
-                if j >= 0:
-                    idx_list_u += [i + b * walk_length] * negative
-            for j in range(i+1, i+1+window_size):
-                if j < walk_length:
-                    idx_list_u += [i + b * walk_length] * negative
+    for i in range(walk_length):
+        for j in range(i-window_size, i):
+            if j >= 0:
+                idx_list_u += [i] * negative
+        for j in range(i+1, i+1+window_size):
+            if j < walk_length:
+                idx_list_u += [i] * negative
+    offset = torch.arange(batch_size).unsqueeze(1) * walk_length
+    index_emb_negu = (torch.LongTensor(idx_list_u) + offset).view(-1)
     
     idx_list_v = list(range(batch_size * walk_length))\
         * negative * window_size * 2
     random.shuffle(idx_list_v)
-    idx_list_v = idx_list_v[:len(idx_list_u)]
+    idx_list_v = idx_list_v[:len(index_emb_negu)]
 
     # [bs * walk_length * negative]
-    index_emb_negu = torch.LongTensor(idx_list_u)
     index_emb_negv = torch.LongTensor(idx_list_v)
 
     return index_emb_negu, index_emb_negv
@@ -79,18 +82,18 @@ def init_grad_avg(walk_length, window_size, batch_size):
     # emb_u.shape: [batch_size * walk_length, dim]
     batch_emb2posu = torch.index_select(emb_u, 0, pos_u_index)
     '''
+    # coefficients of a single walk, the same for every walk in the batch
     grad_avg = []
-    for b in range(batch_size):
-        for i in range(walk_length):
-            if i < window_size:
-                grad_avg.append(1. / float(i+window_size))
-            elif i >= walk_length - window_size:
-                grad_avg.append(1. / float(walk_length - i - 1 + window_size))
-            else:
-                grad_avg.append(0.5 / window_size)
+    for i in range(walk_length):
+        if i < window_size:
+            grad_avg.append(1. / float(i+window_size))
+        elif i >= walk_length - window_size:
+            grad_avg.append(1. / float(walk_length - i - 1 + window_size))
+        else:
+            grad_avg.append(0.5 / window_size)
 
-    # [num_pos * batch_size]
-    return torch.Tensor(grad_avg).unsqueeze(1)
+    # [walk_length * batch_size, 1]
+    return torch.Tensor(grad_avg).repeat(batch_size).unsqueeze(1)
 
 def init_empty_grad(emb_dimension, walk_length, batch_size):
     """ initialize gradient matrix """
@@ -111,6 +114,30 @@ def adam(grad, state_sum, nodes, lr, device, only_gpu):
 
     return grad
 
+@torch.jit.script
+def sgns_loss(emb_u, emb_v, emb_neg_v, neg_weight: float, lap_norm: float):
+    """ negative sampling loss of skip-gram, scripted so that the elementwise
+    ops on the scores are fused instead of each making a pass over memory
+
+    Parameters
+    ----------
+    emb_u torch.Tensor : [num_pairs, dim] embeddings of the center nodes
+    emb_v torch.Tensor : [num_pairs, dim] embeddings of the context nodes
+    emb_neg_v torch.Tensor : [num_pairs, negative, dim] embeddings of the negative nodes
+    neg_weight float : negative weight
+    lap_norm float : weight of the laplacian normalization, lap_norm / 2 * ||emb_u - emb_v||^2
+    """
+    score = torch.sum(emb_u * emb_v, dim=1)
+    score = -F.logsigmoid(torch.clamp(score, max=6., min=-6.))
+
+    neg_score = torch.bmm(emb_neg_v, emb_u.unsqueeze(2)).squeeze(2)
+    neg_score = -F.logsigmoid(-torch.clamp(neg_score, max=6., min=-6.))
+
+    loss = torch.sum(score) + neg_weight * torch.sum(neg_score)
+    if lap_norm > 0:
+        loss = loss + 0.5 * lap_norm * torch.sum((emb_u - emb_v) ** 2)
+    return loss
+
 class SkipGramModel(nn.Module):
     """ Negative sampling based skip-gram """
     def __init__(self, 
@@ -194,12 +221,14 @@ class SkipGramModel(nn.Module):
             self.walk_length,
             self.window_size,
             self.batch_size)
-        if self.fast_neg:
-            self.index_emb_negu, self.index_emb_negv = init_emb2neg_index(
-                self.walk_length,
-                self.window_size,
-                self.negative,
-                self.batch_size)
+        # the number of positive node pairs generated by a single walk sequence
+        self.num_pos = len(self.index_emb_posu) // self.batch_size
+        # the center nodes are also paired with true negatives when fast_neg is off
+        self.index_emb_negu, self.index_emb_negv = init_emb2neg_index(
+            self.walk_length,
+            self.window_size,
+            self.negative,
+            self.batch_size)
 
         # coefficients for averaging the gradients
         if self.avg_sgd:
@@ -222,19 +251,39 @@ class SkipGramModel(nn.Module):
         """ share the parameters across subprocesses """
         self.u_embeddings.weight.share_memory_()
         self.v_embeddings.weight.share_memory_()
+        self.lookup_table.share_memory_()
         if self.adam:
             self.state_sum_u.share_memory_()
             self.state_sum_v.share_memory_()
 
+    def __getstate__(self):
+        """ The gradient buffers are overwritten by every batch, so they are
+        not pickled, e.g. when the model is sent to subprocesses spawned by
+        torch.multiprocessing, which would place them in shared memory.
+        Each process rebuilds its own in __setstate__.
+        """
+        state = self.__dict__.copy()
+        for key in ["grad_u", "grad_v"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        super(SkipGramModel, self).__setstate__(state)
+        grad_u, grad_v = init_empty_grad(
+            self.emb_dimension,
+            self.walk_length,
+            self.batch_size)
+        self.grad_u = grad_u.to(self.device)
+        self.grad_v = grad_v.to(self.device)
+
     def set_device(self, gpu_id):
         self.device = torch.device("cuda:%d" % gpu_id)
         print("The device is", self.device)
         self.lookup_table = self.lookup_table.to(self.device)
         self.index_emb_posu = self.index_emb_posu.to(self.device)
         self.index_emb_posv = self.index_emb_posv.to(self.device)
-        if self.fast_neg:
-            self.index_emb_negu = self.index_emb_negu.to(self.device)
-            self.index_emb_negv = self.index_emb_negv.to(self.device)
+        self.index_emb_negu = self.index_emb_negu.to(self.device)
+        self.index_emb_negv = self.index_emb_negv.to(self.device)
         self.grad_u = self.grad_u.to(self.device)
         self.grad_v = self.grad_v.to(self.device)
         if self.avg_sgd:
@@ -250,9 +299,19 @@ class SkipGramModel(nn.Module):
             self.state_sum_u = self.state_sum_u.to(self.device)
             self.state_sum_v = self.state_sum_v.to(self.device)
 
+    def embeddings_to_bf16(self):
+        """ store the embeddings in bfloat16 to halve the bytes moved by
+        lookups and updates, scores and gradients are still float32
+        """
+        self.u_embeddings.weight.data = self.u_embeddings.weight.data.to(torch.bfloat16)
+        self.v_embeddings.weight.data = self.v_embeddings.weight.data.to(torch.bfloat16)
+
     def fast_sigmoid(self, score):
-        """ do fast sigmoid by looking up in a defined table """
-        idx = torch.floor((score + 6.01) / 0.01).long()
+        """ do fast sigmoid by looking up in a defined table,
+        scores are clamped into the range [-6, 6] of the table
+        """
+        # the shifted score is positive, so truncation by long() is the floor
+        idx = score.clamp(min=-6, max=6).add_(6.01).mul_(100).long()
         return self.lookup_table[idx]
 
     def fast_learn_super(self, batch_walks, lr, neg_nodes=None):
@@ -265,42 +324,39 @@ class SkipGramModel(nn.Module):
 
         Parameters
         ----------
-        batch_walks list : a list of node sequnces
+        batch_walks torch.IntTensor : a [batch_size, walk_length] tensor of node sequences,
+            e.g. a row slice of the walk table, which is only read once
         lr float : current learning rate
-        neg_nodes torch.LongTensor : a long tensor of sampled true negative nodes. If neg_nodes is None,
+        neg_nodes torch.LongTensor : a 1-D long tensor of sampled true negative nodes. If neg_nodes is None,
             then do negative sampling randomly from the nodes in batch_walks as an alternative.
 
         Usage example
         -------------
-        batch_walks = [torch.LongTensor([1,2,3,4]), 
-                       torch.LongTensor([2,3,4,2])])
+        batch_walks = torch.IntTensor([[1,2,3,4],
+                                       [2,3,4,2]])
         lr = 0.01
         neg_nodes = None
         """
         if self.adam:
             lr = self.lr
 
-        # [batch_size, walk_length]
-        nodes = torch.stack(batch_walks)
+        # flattened once and reused by every lookup and update below
+        # [batch_size * walk_length]
+        nodes = batch_walks
         if self.only_gpu:
-            nodes = nodes.to(self.device)
+            nodes = nodes.to(self.device, non_blocking=True)
             if neg_nodes is not None:
                 neg_nodes = neg_nodes.to(self.device)
-        emb_u = self.u_embeddings.weight[nodes].view(-1, self.emb_dimension).to(self.device)
-        emb_v = self.v_embeddings.weight[nodes].view(-1, self.emb_dimension).to(self.device)
+        nodes = nodes.long().view(-1)
+        # scores and gradients are computed in float32 whatever the storage type is
+        emb_u = torch.index_select(self.u_embeddings.weight, 0, nodes).to(self.device, torch.float32)
+        emb_v = torch.index_select(self.v_embeddings.weight, 0, nodes).to(self.device, torch.float32)
 
         ## Postive
         bs = len(batch_walks)
-        if bs < self.batch_size:
-            index_emb_posu, index_emb_posv = init_emb2pos_index(
-                self.walk_length, 
-                self.window_size, 
-                bs)
-            index_emb_posu = index_emb_posu.to(self.device)
-            index_emb_posv = index_emb_posv.to(self.device)
-        else:
-            index_emb_posu = self.index_emb_posu
-            index_emb_posv = self.index_emb_posv
+        # the indexes are laid out walk by walk, a shorter batch uses the leading part
+        index_emb_posu = self.index_emb_posu[:bs * self.num_pos]
+        index_emb_posv = self.index_emb_posv[:bs * self.num_pos]
 
         # num_pos: the number of positive node pairs generated by a single walk sequence
         # [batch_size * num_pos, dim]
@@ -308,54 +364,43 @@ class SkipGramModel(nn.Module):
         emb_pos_v = torch.index_select(emb_v, 0, index_emb_posv)
 
         pos_score = torch.sum(torch.mul(emb_pos_u, emb_pos_v), dim=1)
-        pos_score = torch.clamp(pos_score, max=6, min=-6)
         # [batch_size * num_pos, 1]
         score = (1 - self.fast_sigmoid(pos_score)).unsqueeze(1)
 
         # [batch_size * num_pos, dim]
         if self.lap_norm > 0:
-            grad_u_pos = score * emb_pos_v + self.lap_norm * (emb_pos_v - emb_pos_u)
-            grad_v_pos = score * emb_pos_u + self.lap_norm * (emb_pos_u - emb_pos_v)
+            # score * v + lap_norm * (v - u) == (score + lap_norm) * v - lap_norm * u,
+            # which takes two passes over the pair embeddings instead of four
+            score_lap = score + self.lap_norm
+            grad_u_pos = torch.addcmul(emb_pos_u * -self.lap_norm, score_lap, emb_pos_v)
+            grad_v_pos = torch.addcmul(emb_pos_v * -self.lap_norm, score_lap, emb_pos_u)
         else:
             grad_u_pos = score * emb_pos_v
             grad_v_pos = score * emb_pos_u
         # [batch_size * walk_length, dim]
-        if bs < self.batch_size:
-            grad_u, grad_v = init_empty_grad(
-                self.emb_dimension, 
-                self.walk_length, 
-                bs)
-            grad_u = grad_u.to(self.device)
-            grad_v = grad_v.to(self.device)
-        else:
-            self.grad_u = self.grad_u.to(self.device)
-            self.grad_u.zero_()
-            self.grad_v = self.grad_v.to(self.device)
-            self.grad_v.zero_()
-            grad_u = self.grad_u
-            grad_v = self.grad_v
+        grad_u = self.grad_u[:bs * self.walk_length].zero_()
+        grad_v = self.grad_v[:bs * self.walk_length].zero_()
         grad_u.index_add_(0, index_emb_posu, grad_u_pos)
         grad_v.index_add_(0, index_emb_posv, grad_v_pos)
 
         ## Negative
-        if bs < self.batch_size:
-            index_emb_negu, index_emb_negv = init_emb2neg_index(
+        index_emb_negu = self.index_emb_negu[:bs * self.num_pos * self.negative]
+        if bs < self.batch_size and neg_nodes is None:
+            # the sampled positions have to fall into the shorter batch
+            _, index_emb_negv = init_emb2neg_index(
                 self.walk_length, self.window_size, self.negative, bs)
-            index_emb_negu = index_emb_negu.to(self.device)
             index_emb_negv = index_emb_negv.to(self.device)
         else:
-            index_emb_negu = self.index_emb_negu
             index_emb_negv = self.index_emb_negv
 
         emb_neg_u = torch.index_select(emb_u, 0, index_emb_negu)
         if neg_nodes is None:
             emb_neg_v = torch.index_select(emb_v, 0, index_emb_negv)
         else:
-            emb_neg_v = self.v_embeddings.weight[neg_nodes].to(self.device)
+            emb_neg_v = torch.index_select(self.v_embeddings.weight, 0, neg_nodes).to(self.device, torch.float32)
 
         # [batch_size * walk_length * negative, dim]
         neg_score = torch.sum(torch.mul(emb_neg_u, emb_neg_v), dim=1)
-        neg_score = torch.clamp(neg_score, max=6, min=-6)
         # [batch_size * walk_length * negative, 1]
         score = - self.fast_sigmoid(neg_score).unsqueeze(1)
 
@@ -367,15 +412,8 @@ class SkipGramModel(nn.Module):
             grad_v.index_add_(0, index_emb_negv, grad_v_neg)
 
         ## Update
-        nodes = nodes.view(-1)
         if self.avg_sgd:
-            if bs < self.batch_size:
-                grad_avg = init_grad_avg(
-                    self.walk_length,
-                    self.window_size,
-                    bs).to(self.device)
-            else:
-                grad_avg = self.grad_avg
+            grad_avg = self.grad_avg[:bs * self.walk_length]
             grad_u = grad_avg * grad_u * lr
             grad_v = grad_avg * grad_v * lr
         elif self.sgd:
@@ -391,28 +429,67 @@ class SkipGramModel(nn.Module):
             if neg_nodes is not None:
                 grad_v_neg = grad_v_neg.cpu()
         
-        self.u_embeddings.weight.data.index_add_(0, nodes.view(-1), grad_u)
-        self.v_embeddings.weight.data.index_add_(0, nodes.view(-1), grad_v)            
+        emb_dtype = self.u_embeddings.weight.dtype
+        self.u_embeddings.weight.data.index_add_(0, nodes, grad_u.to(emb_dtype))
+        self.v_embeddings.weight.data.index_add_(0, nodes, grad_v.to(emb_dtype))
         if neg_nodes is not None:
-            self.v_embeddings.weight.data.index_add_(0, neg_nodes.view(-1), lr * grad_v_neg)
+            self.v_embeddings.weight.data.index_add_(0, neg_nodes, (lr * grad_v_neg).to(emb_dtype))
         return
 
+    def sparse_adam_learn(self, batch_walks, optimizer, neg_nodes=None):
+        """ Learn a batch of random walks with autograd and an optimizer
+        taking sparse gradients, e.g. torch.optim.SparseAdam, so that only
+        the embedding rows touched by the batch get gradients and states.
+
+        Parameters
+        ----------
+        batch_walks torch.IntTensor : a [batch_size, walk_length] tensor of node sequences
+        optimizer torch.optim.Optimizer : optimizer of the embeddings
+        neg_nodes torch.LongTensor : a long tensor of sampled true negative nodes. If neg_nodes is None,
+            then do negative sampling randomly from the nodes in batch_walks as an alternative.
+        """
+        nodes = batch_walks
+        if self.only_gpu:
+            nodes = nodes.to(self.device, non_blocking=True)
+            if neg_nodes is not None:
+                neg_nodes = neg_nodes.to(self.device)
+        nodes = nodes.long().view(-1)
+
+        bs = len(batch_walks)
+        # the indexes were placed on the device of the walks by set_device
+        index_emb_posu = self.index_emb_posu[:bs * self.num_pos]
+        index_emb_posv = self.index_emb_posv[:bs * self.num_pos]
+
+        # the negative nodes of a pair are contrasted with its center node,
+        # as done in fast_learn_super
+        pos_u = nodes[index_emb_posv]
+        pos_v = nodes[index_emb_posu]
+        if neg_nodes is None:
+            if bs < self.batch_size:
+                _, index_emb_negv = init_emb2neg_index(
+                    self.walk_length, self.window_size, self.negative, bs)
+                index_emb_negv = index_emb_negv.to(nodes.device)
+            else:
+                index_emb_negv = self.index_emb_negv
+            neg_v = nodes[index_emb_negv]
+        else:
+            neg_v = neg_nodes
+        # [batch_size * num_pos, negative]
+        neg_v = neg_v.view(-1, self.negative)
+
+        with torch.enable_grad():
+            loss = self.forward(pos_u, pos_v, neg_v)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
     def forward(self, pos_u, pos_v, neg_v):
-        ''' for future use '''
+        ''' loss of positive and negative node pairs, used by sparse_adam_learn '''
         emb_u = self.u_embeddings(pos_u)
         emb_v = self.v_embeddings(pos_v)
         emb_neg_v = self.v_embeddings(neg_v)
 
-        score = torch.sum(torch.mul(emb_u, emb_v), dim=1)
-        score = torch.clamp(score, max=6, min=-6)
-        score = -F.logsigmoid(score)
-
-        neg_score = torch.bmm(emb_neg_v, emb_u.unsqueeze(2)).squeeze()
-        neg_score = torch.clamp(neg_score, max=6, min=-6)
-        neg_score = -torch.sum(F.logsigmoid(-neg_score), dim=1)
-
-        #return torch.mean(score + neg_score)
-        return torch.sum(score), torch.sum(neg_score)
+        return sgns_loss(emb_u, emb_v, emb_neg_v, self.neg_weight, self.lap_norm)
 
     def save_embedding(self, dataset, file_name):
         """ Write embedding to local file
@@ -422,7 +499,7 @@ class SkipGramModel(nn.Module):
         dataset DeepwalkDataset : the dataset
         file_name str : the file name
         """
-        embedding = self.u_embeddings.weight.cpu().data.numpy()
+        embedding = self.u_embeddings.weight.cpu().data.float().numpy()
         with open(file_name, 'w') as f:
             f.write('%d %d\n' % (self.emb_size, self.emb_dimension))
             for wid in range(self.emb_size):
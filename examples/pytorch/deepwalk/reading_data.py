@@ -3,6 +3,9 @@ import dgl
 import torch
 import random
 import time
+import itertools
+
+from utils import init_alias_table
 np.random.seed(3141592653)
 
 def ReadTxtNet(file_path=""):
@@ -56,10 +59,15 @@ def net2graph(net):
     ------
     G DGLGraph : graph by DGL
     """
+    # all of the edges are added at once, in the same order as node by node
+    nodes = np.fromiter(net.keys(), dtype=np.int64, count=len(net))
+    degrees = np.fromiter(map(len, net.values()), dtype=np.int64, count=len(net))
+    src = np.repeat(nodes, degrees)
+    dst = np.fromiter(itertools.chain.from_iterable(net.values()),
+        dtype=np.int64, count=int(degrees.sum()))
     G = dgl.DGLGraph()
     G.add_nodes(len(net))
-    for i in net:
-        G.add_edges(i, list(net[i].keys()))
+    G.add_edges(torch.from_numpy(src), torch.from_numpy(dst))
     return G
 
 class DeepwalkDataset:
@@ -75,7 +83,7 @@ class DeepwalkDataset:
         """ This class has the following functions:
         1. Transform the txt network file into DGL graph;
         2. Generate random walk sequences for the trainer;
-        3. Provide the negative table if the user hopes to sample negative
+        3. Provide the negative alias table if the user hopes to sample negative
         nodes according to nodes' degrees;
 
         Parameter
@@ -100,21 +108,27 @@ class DeepwalkDataset:
         start = time.time()
         walks = dgl.contrib.sampling.random_walk(self.G, self.G.nodes(), 
                 self.num_walks, self.walk_length-1)
-        self.walks = walks.view(-1, self.walk_length)
+        # the traces come back as one [num_nodes, num_walks, walk_length] tensor, keep
+        # them as a contiguous [num_nodes * num_walks, walk_length] table without
+        # splitting into per-walk objects; batches are row slices of it
+        self.walks = walks.view(-1, self.walk_length).to(torch.int32)
         end = time.time()
         t = end - start
         print("%d walks in %.2fs" % (len(self.walks), t))
 
-        # negative table for true negative sampling
+        # alias table for true negative sampling
         if not fast_neg:
-            node_degree = np.array(list(map(lambda x: len(self.net[x]), self.net.keys())))
+            node_degree = np.array([len(self.net[x]) for x in range(len(self.net))])
             node_degree = np.power(node_degree, 0.75)
-            node_degree /= np.sum(node_degree)
-            node_degree = np.array(node_degree * 1e8, dtype=np.int)
-            self.neg_table = []
-            for idx, node in enumerate(self.net.keys()):
-                self.neg_table += [node] * node_degree[idx]
-            self.neg_table_size = len(self.neg_table)
-            self.neg_table = np.array(self.neg_table, dtype=np.long)
+            self.neg_prob, self.neg_alias = init_alias_table(node_degree)
             del node_degree
-        
\ No newline at end of file
+
+    def __getstate__(self):
+        """ Only the training tensors are pickled, e.g. when the trainer is sent
+        to subprocesses spawned by torch.multiprocessing. The network dict,
+        the id maps and the DGL graph stay in the parent process.
+        """
+        state = self.__dict__.copy()
+        for key in ["net", "node2id", "id2node", "G"]:
+            state.pop(key, None)
+        return state
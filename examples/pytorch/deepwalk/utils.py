@@ -1,37 +1,79 @@
 import torch
-from functools import wraps
-from _thread import start_new_thread
-import torch.multiprocessing as mp
-
-def thread_wrapped_func(func):
-    """Wrapped func for torch.multiprocessing.Process.
-    With this wrapper we can use OMP threads in subprocesses
-    otherwise, OMP_NUM_THREADS=1 is mandatory.
-    How to use:
-    @thread_wrapped_func
-    def func_to_wrap(args ...):
+import numpy as np
+
+def shuffle_walks(walks):
+    """ Shuffle the rows of the walk table with a single permutation,
+    generated on the device of the walks so that no index is copied to it.
+    """
+    seeds = torch.randperm(walks.size(0), device=walks.device)
+    return torch.index_select(walks, 0, seeds)
+
+def init_lr_schedule(lr, max_i, min_lr=0.00001):
+    """ Precompute the linearly decayed learning rate of every batch.
+
+    The rates are python floats, which are passed to kernels by value,
+    so indexing the schedule costs no host-to-device copy.
+    """
+    return np.maximum(lr * (max_i - np.arange(max_i)) / max_i, min_lr).tolist()
+
+def init_alias_table(weights):
+    """ Build a Vose alias table from unnormalized sampling weights,
+    so that drawing one sample costs O(1) regardless of the distribution.
+
+    Return
+    ------
+    prob torch.FloatTensor : acceptance probability of each column
+    alias torch.LongTensor : the alternative index of each column
     """
-    @wraps(func)
-    def decorated_function(*args, **kwargs):
-        queue = mp.Queue()
-        def _queue_result():
-            exception, trace, res = None, None, None
-            try:
-                res = func(*args, **kwargs)
-            except Exception as e:
-                exception = e
-                trace = traceback.format_exc()
-            queue.put((res, exception, trace))
-
-        start_new_thread(_queue_result, ())
-        result, exception, trace = queue.get()
-        if exception is None:
-            return result
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64)
+    scaled = scaled * n / scaled.sum()
+    prob = np.zeros(n, dtype=np.float32)
+    alias = np.arange(n, dtype=np.int64)
+
+    small = list(np.nonzero(scaled < 1.)[0])
+    large = list(np.nonzero(scaled >= 1.)[0])
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.
+        if scaled[l] < 1.:
+            small.append(l)
         else:
-            assert isinstance(exception, Exception)
-            raise exception.__class__(trace)
-    return decorated_function
+            large.append(l)
+    # the remaining columns are full up to numerical error
+    for idx in small + large:
+        prob[idx] = 1.
 
-def shuffle_walks(walks):
-    seeds = torch.randperm(walks.size()[0])
-    return walks[seeds]
\ No newline at end of file
+    return torch.from_numpy(prob), torch.from_numpy(alias)
+
+class AliasSampler:
+    """ Draw samples from an alias table on the device where it resides.
+
+    The random numbers and the samples are written into buffers allocated
+    once for up to max_n samples, so sampling a batch allocates nothing.
+    They are drawn from generator, which should live on the same device,
+    so that on GPU the sampling is just more kernels on the current stream.
+    """
+    def __init__(self, prob, alias, max_n, generator=None):
+        self.prob = prob
+        self.alias = alias
+        self.generator = generator
+        device = prob.device
+        self.col = torch.empty(max_n, dtype=torch.int64, device=device)
+        self.coin = torch.empty(max_n, dtype=prob.dtype, device=device)
+        self.col_prob = torch.empty(max_n, dtype=prob.dtype, device=device)
+        self.reject = torch.empty(max_n, dtype=torch.bool, device=device)
+        self.samples = torch.empty(max_n, dtype=torch.int64, device=device)
+
+    def sample(self, n):
+        """ draw n samples, returned in a buffer overwritten by the next call """
+        col = self.col[:n].random_(0, self.prob.numel(), generator=self.generator)
+        coin = self.coin[:n].uniform_(generator=self.generator)
+        col_prob = torch.index_select(self.prob, 0, col, out=self.col_prob[:n])
+        reject = torch.ge(coin, col_prob, out=self.reject[:n])
+        samples = torch.index_select(self.alias, 0, col, out=self.samples[:n])
+        # keep the column where the coin is accepted and take its alias otherwise
+        return samples.sub_(col).mul_(reject).add_(col)